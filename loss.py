@@ -50,11 +50,14 @@ class GRPOLoss(nn.Module):
         action_mask = experience.action_mask
         advantages = experience.advantages
 
-        kl = approx_kl_divergence(
-            log_probs=log_probs,
-            log_probs_ref=log_probs_ref,
-            action_mask=action_mask,
-        )
+        if log_probs_ref is not None:
+            kl = approx_kl_divergence(
+                log_probs=log_probs,
+                log_probs_ref=log_probs_ref,
+                action_mask=action_mask,
+            )
+        else:
+            kl = torch.zeros_like(log_probs)
 
         ratio = (log_probs - old_log_probs).exp()
         surr1 = ratio * advantages
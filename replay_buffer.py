@@ -1,12 +1,13 @@
 from dataclasses import dataclass, fields
-from typing import Optional, Self
+from typing import Iterator, Optional, Self
 
 import torch
 import torch.nn.functional as F
+from torch.utils.data import Sampler
 
 
 def zero_pad_sequences(
-    sequences: list[torch.Tensor], side: str = "left"
+    sequences: list[torch.Tensor], side: str = "left", value: int = 0
 ) -> torch.Tensor:
     assert side in ("left", "right")
     max_len = max(seq.size(0) for seq in sequences)
@@ -14,7 +15,7 @@ def zero_pad_sequences(
     for seq in sequences:
         pad_len = max_len - seq.size(0)
         padding = (pad_len, 0) if side == "left" else (0, pad_len)
-        padded_sequences.append(F.pad(seq, padding))
+        padded_sequences.append(F.pad(seq, padding, value=value))
     return torch.stack(padded_sequences, dim=0)
 
 
@@ -22,7 +23,7 @@ def zero_pad_sequences(
 class Experience:
     sequences: torch.Tensor
     action_log_probs: torch.Tensor
-    log_probs_ref: torch.Tensor
+    log_probs_ref: Optional[torch.Tensor]
     returns: Optional[torch.Tensor]
     advantages: Optional[torch.Tensor]
     attention_mask: Optional[torch.Tensor]
@@ -30,11 +31,15 @@ class Experience:
     kl: Optional[torch.Tensor] = None
 
     def to(self, device: torch.device) -> Self:
+        # host -> GPU copies go through pinned memory so they can be asynchronous
+        non_blocking = torch.device(device).type == "cuda"
         members = {}
         for field in fields(self):
             v = getattr(self, field.name)
             if isinstance(v, torch.Tensor):
-                v = v.to(device=device)
+                if non_blocking and v.device.type == "cpu" and not v.is_pinned():
+                    v = v.pin_memory()
+                v = v.to(device=device, non_blocking=non_blocking)
             members[field.name] = v
         return Experience(**members)
 
@@ -64,6 +69,22 @@ def split_experience_batch(experience: Experience) -> list[Experience]:
     return [Experience(**data) for data in batch_data]
 
 
+def trim_experience_padding(experience: Experience) -> Experience:
+    """Drop leading/trailing pad columns of a single (unbatched) experience"""
+    (valid,) = experience.attention_mask.nonzero(as_tuple=True)
+    start, end = valid[0].item(), valid[-1].item() + 1
+    members = {}
+    for field in fields(experience):
+        v = getattr(experience, field.name)
+        if field.name in ("sequences", "attention_mask"):
+            v = v[start:end]
+        elif field.name in ("action_log_probs", "log_probs_ref", "action_mask"):
+            if v is not None:
+                v = v[start : end - 1]
+        members[field.name] = v
+    return Experience(**members)
+
+
 def join_experience_batch(items: list[Experience]) -> Experience:
     batch_data = {}
     keys = (
@@ -91,7 +112,10 @@ class ReplayBuffer:
         self.items: list[Experience] = []
 
     def append(self, experience: Experience) -> None:
-        items = split_experience_batch(experience)
+        items = [
+            trim_experience_padding(item)
+            for item in split_experience_batch(experience)
+        ]
         self.items.extend(items)
         if self.limit > 0:
             samples_to_remove = len(self.items) - self.limit
@@ -106,3 +130,164 @@ class ReplayBuffer:
 
     def __getitem__(self, idx: int) -> Experience:
         return self.items[idx]
+
+
+class LengthBucketSampler(Sampler[list[int]]):
+    """Batch sampler grouping experiences of similar length, in shuffled batch order"""
+
+    def __init__(
+        self,
+        lengths: list[int],
+        batch_size: int,
+        drop_last: bool = True,
+        generator: Optional[torch.Generator] = None,
+    ) -> None:
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.generator = generator
+
+    def __iter__(self) -> Iterator[list[int]]:
+        perm = torch.randperm(len(self.lengths), generator=self.generator).tolist()
+        if self.drop_last:
+            # drop a random remainder, not the longest sequences after sorting
+            perm = perm[: len(perm) - len(perm) % self.batch_size]
+        order = sorted(perm, key=lambda i: self.lengths[i])
+        batches = [
+            order[i : i + self.batch_size]
+            for i in range(0, len(order), self.batch_size)
+        ]
+        for i in torch.randperm(len(batches), generator=self.generator).tolist():
+            yield batches[i]
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+class PackedReplayBuffer:
+    """Replay buffer storing all experiences packed into flat (struct of arrays) tensors
+
+    Sequence i spans tokens cu_seqlens[i]:cu_seqlens[i + 1], padding is dropped.
+    Per-token fields are aligned with the token they score, i.e. action_mask[t]
+    marks token t as an action and action_log_probs[t] is its log prob.
+    """
+
+    def __init__(self) -> None:
+        self.clear()
+
+    def clear(self) -> None:
+        self.sequences = torch.empty(0, dtype=torch.int32)
+        self.cu_seqlens = torch.zeros(1, dtype=torch.int32)
+        self.action_mask = torch.empty(0, dtype=torch.bool)
+        self.action_log_probs = torch.empty(0, dtype=torch.float32)
+        self.log_probs_ref: Optional[torch.Tensor] = torch.empty(0, dtype=torch.float16)
+        self.returns = torch.empty(0, dtype=torch.float32)
+        self.advantages = torch.empty(0, dtype=torch.float32)
+        # appended chunks per field, concatenated once on first read
+        self._pending: dict[str, list[torch.Tensor]] = {
+            name: []
+            for name in (
+                "sequences",
+                "cu_seqlens",
+                "action_mask",
+                "action_log_probs",
+                "log_probs_ref",
+                "returns",
+                "advantages",
+            )
+        }
+        self._num_tokens = 0
+        self._num_sequences = 0
+
+    def append(self, experience: Experience) -> None:
+        mask = experience.attention_mask.bool()
+
+        def per_token(v: torch.Tensor) -> torch.Tensor:
+            # [B, T-1] values of predicted tokens -> packed values of kept tokens
+            return F.pad(v, (1, 0))[mask]
+
+        seqlens = mask.sum(dim=1, dtype=torch.int32)
+        cu_seqlens = self._num_tokens + seqlens.cumsum(dim=0, dtype=torch.int32)
+        self._num_tokens = cu_seqlens[-1].item()
+        self._num_sequences += seqlens.size(0)
+
+        pending = self._pending
+        pending["sequences"].append(experience.sequences[mask].to(torch.int32))
+        pending["cu_seqlens"].append(cu_seqlens)
+        pending["action_mask"].append(per_token(experience.action_mask))
+        pending["action_log_probs"].append(
+            per_token(experience.action_log_probs).float()
+        )
+        if experience.log_probs_ref is None:
+            self.log_probs_ref = None
+        elif self.log_probs_ref is not None:
+            pending["log_probs_ref"].append(per_token(experience.log_probs_ref).half())
+        pending["returns"].append(experience.returns.view(-1).float())
+        pending["advantages"].append(experience.advantages.view(-1).float())
+
+    def _finalize(self) -> None:
+        for name, chunks in self._pending.items():
+            if not chunks:
+                continue
+            packed = getattr(self, name)
+            if packed is not None:
+                setattr(self, name, torch.cat([packed, *chunks]))
+            chunks.clear()
+
+    def seqlens(self) -> torch.Tensor:
+        self._finalize()
+        return self.cu_seqlens[1:] - self.cu_seqlens[:-1]
+
+    def get_batch(self, indices: list[int]) -> Experience:
+        """Gather the given sequences into a right-padded batch in pinned memory"""
+        self._finalize()
+        spans = [
+            (self.cu_seqlens[i].item(), self.cu_seqlens[i + 1].item()) for i in indices
+        ]
+        max_len = max(e - s for s, e in spans)
+        index = torch.tensor(indices)
+
+        # every field is written straight into pinned memory in its final dtype,
+        # so Experience.to() can start the host -> GPU copy without staging
+        def gather(
+            packed: torch.Tensor, dtype: Optional[torch.dtype] = None, offset: int = 0
+        ) -> torch.Tensor:
+            batch = torch.zeros(
+                len(spans),
+                max_len - offset,
+                dtype=dtype or packed.dtype,
+                pin_memory=True,
+            )
+            for row, (s, e) in enumerate(spans):
+                batch[row, : e - s - offset] = packed[s + offset : e]
+            return batch
+
+        def gather_rows(packed: torch.Tensor) -> torch.Tensor:
+            out = torch.empty(len(indices), dtype=packed.dtype, pin_memory=True)
+            return torch.index_select(packed, 0, index, out=out).unsqueeze(-1)
+
+        attention_mask = torch.zeros(
+            len(spans), max_len, dtype=torch.bool, pin_memory=True
+        )
+        for row, (s, e) in enumerate(spans):
+            attention_mask[row, : e - s] = True
+
+        # per-token fields drop the first token, column j scores token j + 1
+        return Experience(
+            sequences=gather(self.sequences, dtype=torch.long),
+            action_log_probs=gather(self.action_log_probs, offset=1),
+            log_probs_ref=(
+                gather(self.log_probs_ref, dtype=torch.float32, offset=1)
+                if self.log_probs_ref is not None
+                else None
+            ),
+            returns=gather_rows(self.returns),
+            advantages=gather_rows(self.advantages),
+            attention_mask=attention_mask,
+            action_mask=gather(self.action_mask, offset=1),
+        )
+
+    def __len__(self) -> int:
+        return self._num_sequences
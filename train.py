@@ -1,10 +1,13 @@
 from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import fields
 import json
 import os
 from pathlib import Path
 import random
 import re
 from typing import Any, Iterator, Optional
+import numpy as np
 import wandb
 import torch
 import torch.optim as optim
@@ -12,17 +15,34 @@ import torch.nn.functional as F
 from torch.nn.utils import clip_grad_norm_
 from torch.utils.data import DataLoader
 import torch.distributed as dist
-from torch.distributed._composable.fsdp import fully_shard, MixedPrecisionPolicy
+from torch.distributed._composable.fsdp import (
+    CPUOffloadPolicy,
+    MixedPrecisionPolicy,
+    OffloadPolicy,
+    fully_shard,
+)
+from torch.distributed.algorithms._checkpoint.checkpoint_wrapper import (
+    _CHECKPOINT_PREFIX,
+    CheckpointImpl,
+    checkpoint_wrapper,
+)
+from vllm import LLM, SamplingParams
 
 from transformers import (
     AutoTokenizer,
     PreTrainedTokenizer,
+    BitsAndBytesConfig,
     LlamaForCausalLM,
     GenerationConfig,
 )
 from ckpt_utils import save_checkpoint
-from loss import approx_kl_divergence, GRPOLoss
-from replay_buffer import ReplayBuffer, Experience, join_experience_batch
+from loss import approx_kl_divergence, masked_mean, GRPOLoss
+from replay_buffer import (
+    PackedReplayBuffer,
+    Experience,
+    LengthBucketSampler,
+    zero_pad_sequences,
+)
 
 
 def load_model(
@@ -30,6 +50,7 @@ def load_model(
     trust_remote_code: bool = False,
     bf16: bool = True,
     device_map=None,
+    load_in_8bit: bool = False,
 ) -> tuple[LlamaForCausalLM, PreTrainedTokenizer]:
     tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
     tokenizer.pad_token = tokenizer.eos_token
@@ -39,6 +60,12 @@ def load_model(
         attn_implementation="flash_attention_2",
         torch_dtype=torch.bfloat16 if bf16 else "auto",
         device_map=device_map,
+        # int8 weight Linear layers (LLM.int8()), embeddings/norms/lm_head stay bf16
+        quantization_config=(
+            BitsAndBytesConfig(load_in_8bit=True, llm_int8_threshold=6.0)
+            if load_in_8bit
+            else None
+        ),
     )
     return model, tokenizer
 
@@ -49,53 +76,42 @@ The assistant first thinks about the reasoning process in the mind and then prov
 <answer> answer here </answer>
 """
 
+answer_pattern = re.compile(r"<answer>(.*?)</answer>", flags=re.DOTALL)
+
 
 @torch.no_grad()
 def rollout(
     model: LlamaForCausalLM,
     tokenizer: PreTrainedTokenizer,
-    task: str,
-    oracle_answer: str,
+    prompt_ids: list[torch.Tensor],
+    oracle_answers: list[str],
     num_rollouts: int,
     max_length: int = 1024,
     temperature: float = 1.0,
     top_p: float = 1.0,
-) -> tuple[torch.Tensor, torch.Tensor, list[str]]:
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
 
     model.eval()
 
-    # 1. format prompt
-    chat_messages = [
-        {
-            "role": "system",
-            "content": system_prompt,
-        },
-        {
-            "role": "user",
-            "content": task,
-        },
-    ]
-    chat_prompt = tokenizer.apply_chat_template(
-        chat_messages, tokenize=False, add_generation_prompt=True
-    )
-    model_inputs = tokenizer(
-        [chat_prompt],
-        return_tensors="pt",
-        padding=True,
-        padding_side="left",
-        return_attention_mask=True,
-    ).to("cuda")
-
-    # duplicate prompt num_rollouts times
-    model_inputs["attention_mask"] = model_inputs["attention_mask"].repeat(
-        num_rollouts, 1
+    # 1. left-pad the pre-tokenized prompts
+    pad_token_id = tokenizer.eos_token_id
+    model_inputs = {
+        "input_ids": zero_pad_sequences(prompt_ids, side="left", value=pad_token_id),
+        "attention_mask": zero_pad_sequences(
+            [torch.ones_like(ids) for ids in prompt_ids], side="left"
+        ),
+    }
+    model_inputs = {key: value.to("cuda") for key, value in model_inputs.items()}
+
+    # duplicate each prompt num_rollouts times, groups stay contiguous
+    model_inputs["attention_mask"] = model_inputs["attention_mask"].repeat_interleave(
+        num_rollouts, dim=0
     )
 
-    input_ids = model_inputs["input_ids"].repeat(num_rollouts, 1)
+    input_ids = model_inputs["input_ids"].repeat_interleave(num_rollouts, dim=0)
     model_inputs["input_ids"] = input_ids
 
-    # 2. sample completions
-    pad_token_id = tokenizer.eos_token_id
+    # 2. sample completions for all groups in a single generate call
     generation_config = GenerationConfig(
         do_sample=True,
         top_p=top_p,
@@ -103,7 +119,11 @@ def rollout(
         max_length=max_length,
         pad_token_id=pad_token_id,
     )
-    sequence_ids = model.generate(**model_inputs, generation_config=generation_config)
+    # decode steps change shapes every token, keep generate out of compiled code
+    with torch.compiler.set_stance("force_eager"):
+        sequence_ids = model.generate(
+            **model_inputs, generation_config=generation_config
+        )
     completions = tokenizer.batch_decode(
         sequence_ids[:, input_ids.shape[1] :], skip_special_tokens=True
     )
@@ -113,29 +133,135 @@ def rollout(
     action_mask[sequence_ids == pad_token_id] = False
     action_mask = action_mask[:, 1:]
 
-    # 3. determine rewards
-    returns = torch.zeros(num_rollouts, 1, dtype=torch.float)
-    for i, completion in enumerate(completions):
+    # 3. determine rewards, they stay on the CPU
+    returns = compute_returns(
+        completions, [a for a in oracle_answers for _ in range(num_rollouts)]
+    )
+
+    return sequence_ids, returns, action_mask
+
+
+def compute_returns(completions: list[str], oracle_answers: list[str]) -> torch.Tensor:
+    returns = torch.zeros(len(completions), 1, dtype=torch.float)
+    for i, (completion, oracle_answer) in enumerate(zip(completions, oracle_answers)):
         # search answer tag
-        answer_match = re.search(
-            r"<answer>(.*?)</answer>",
-            completion,
-            flags=re.DOTALL,
-        )
+        answer_match = answer_pattern.search(completion)
 
         answer = answer_match.group(1) if answer_match else None
         reward = 0
         if answer is not None:
-            if answer == oracle_answer:
+            # exact match iff the oracle is found and the lengths agree
+            if answer.find(oracle_answer) == -1:
+                reward = 0.01
+            elif len(answer) == len(oracle_answer):
                 reward = 1.0
-            elif oracle_answer in answer:
-                reward = 0.5
             else:
-                reward = 0.01
+                reward = 0.5
 
         returns[i] = reward
 
-    return sequence_ids, returns.to(sequence_ids.device), action_mask, completions
+    return returns
+
+
+def load_vllm(
+    model_name_or_path: str,
+    max_length: int = 1024,
+    gpu_memory_utilization: float = 0.3,
+    tensor_parallel_size: int = 1,
+    seed: int = 0,
+) -> LLM:
+    """Create a vLLM engine colocated with the FSDP training model on this rank
+
+    Every torchrun rank hosts one engine worker. Consecutive groups of
+    tensor_parallel_size ranks form one engine, the groups act as data-parallel
+    replicas (supported by the external launcher since vLLM 0.8).
+    """
+    assert dist.get_world_size() % tensor_parallel_size == 0
+    # the V0 engine exposes the worker's model for in-place weight updates
+    os.environ.setdefault("VLLM_USE_V1", "0")
+    return LLM(
+        model=model_name_or_path,
+        dtype="bfloat16",
+        gpu_memory_utilization=gpu_memory_utilization,
+        max_model_len=max_length,
+        tensor_parallel_size=tensor_parallel_size,
+        seed=seed,
+        enable_sleep_mode=True,
+        distributed_executor_backend="external_launcher",
+    )
+
+
+@torch.no_grad()
+def sync_vllm_weights(llm: LLM, model: LlamaForCausalLM) -> None:
+    """Stream the current (sharded) policy weights into the vLLM engine
+
+    Parameters are gathered one at a time, so only a single full bf16 tensor
+    is materialized on top of the shards at any point.
+    """
+    weights = (
+        (
+            name.replace(_CHECKPOINT_PREFIX, ""),
+            param.full_tensor().to(torch.bfloat16),
+        )
+        for name, param in model.named_parameters()
+    )
+    llm_model = llm.llm_engine.model_executor.driver_worker.model_runner.model
+    llm_model.load_weights(weights)
+
+
+@torch.no_grad()
+def rollout_vllm(
+    llm: LLM,
+    tokenizer: PreTrainedTokenizer,
+    prompt_ids: list[torch.Tensor],
+    oracle_answers: list[str],
+    num_rollouts: int,
+    max_length: int = 1024,
+    temperature: float = 1.0,
+    top_p: float = 1.0,
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+
+    # 1. prompts are pre-tokenized
+    prompt_len = max(ids.size(0) for ids in prompt_ids)
+
+    # 2. sample completions, n= lets the engine share each prompt's KV cache
+    sampling_params = SamplingParams(
+        n=num_rollouts,
+        top_p=top_p,
+        temperature=temperature,
+        max_tokens=max_length - prompt_len,
+    )
+    request_outputs = llm.generate(
+        [{"prompt_token_ids": ids.tolist()} for ids in prompt_ids],
+        sampling_params=sampling_params,
+        use_tqdm=False,
+    )
+    outputs = [o for request_output in request_outputs for o in request_output.outputs]
+    completions = [o.text for o in outputs]
+
+    # rebuild left-padded prompts + right-padded completions from the engine output
+    pad_token_id = tokenizer.eos_token_id
+    input_ids = zero_pad_sequences(
+        prompt_ids, side="left", value=pad_token_id
+    ).repeat_interleave(num_rollouts, dim=0)
+    completion_ids = zero_pad_sequences(
+        [torch.tensor(o.token_ids, dtype=torch.long) for o in outputs],
+        side="right",
+        value=pad_token_id,
+    )
+    sequence_ids = torch.cat([input_ids, completion_ids], dim=1).to("cuda")
+
+    action_mask = torch.zeros_like(sequence_ids, dtype=torch.bool)
+    action_mask[:, prompt_len:] = True
+    action_mask[sequence_ids == pad_token_id] = False
+    action_mask = action_mask[:, 1:]
+
+    # 3. determine rewards, they stay on the CPU
+    returns = compute_returns(
+        completions, [a for a in oracle_answers for _ in range(num_rollouts)]
+    )
+
+    return sequence_ids, returns, action_mask
 
 
 def init_rng(seed: int) -> torch.Generator:
@@ -147,32 +273,162 @@ def group_advantages(returns: torch.Tensor, eps: float = 1e-8) -> torch.Tensor:
     return (returns - returns.mean()) / (returns.std() + eps)
 
 
+@torch.compile(fullgraph=True, dynamic=True)
 def sequence_log_probs_from_logits(
     logits: torch.tensor, output_ids: torch.tensor
 ) -> torch.Tensor:
-    log_prob = F.log_softmax(logits, dim=-1)
-    return log_prob.gather(dim=-1, index=output_ids.unsqueeze(-1)).squeeze(-1)
+    # log p(target) = logit[target] - logsumexp(logits), the upcast happens
+    # inside the fused kernel so no fp32 [B, T, V] tensor is materialized
+    logits = logits.float()
+    lse = torch.logsumexp(logits, dim=-1)
+    target = logits.gather(dim=-1, index=output_ids.unsqueeze(-1)).squeeze(-1)
+    return target - lse
 
 
 def sequences_log_probs(
     model: LlamaForCausalLM,
     sequence_ids: torch.Tensor,
     attention_mask: torch.Tensor,
+    action_mask: torch.Tensor,
 ) -> torch.Tensor:
+    # unpad into a single packed row, flash_attention_2 detects the sequence
+    # boundaries from the restarting position ids and runs its varlen kernel
+    attention_mask = attention_mask.bool()
     position_ids = attention_mask.long().cumsum(dim=-1) - 1
-    position_ids.masked_fill_(mask=(attention_mask == 0), value=1)
+    packed_ids = sequence_ids[attention_mask].unsqueeze(0)
+    packed_position_ids = position_ids[attention_mask].unsqueeze(0)
+
+    # only the hidden states predicting an action token go through the LM head,
+    # action t is scored by the logits at packed position t - 1. The first
+    # token of a sequence is never an action, so t - 1 stays inside it.
+    (action_idx,) = F.pad(action_mask, (1, 0))[attention_mask].nonzero(as_tuple=True)
+
     output = model(
-        input_ids=sequence_ids,
-        attention_mask=attention_mask,
-        position_ids=position_ids,
+        input_ids=packed_ids,
+        position_ids=packed_position_ids,
         use_cache=False,
+        logits_to_keep=action_idx - 1,
     )
     logits = output["logits"]
-    log_probs = sequence_log_probs_from_logits(
-        logits=logits[:, :-1].to(torch.float32),
-        output_ids=sequence_ids[:, 1:],
+    action_log_probs = sequence_log_probs_from_logits(
+        logits=logits,
+        output_ids=packed_ids[:, action_idx],
     )
-    return log_probs
+
+    # scatter back to [B, T - 1], column j holds the log prob of token j + 1,
+    # non-action columns are zero and masked by action_mask
+    token_log_probs = torch.zeros(
+        packed_ids.size(1), dtype=action_log_probs.dtype, device=packed_ids.device
+    ).index_put((action_idx,), action_log_probs[0])
+    padded_log_probs = torch.zeros(
+        attention_mask.shape, dtype=token_log_probs.dtype, device=attention_mask.device
+    ).masked_scatter(attention_mask, token_log_probs)
+    return padded_log_probs[:, 1:]
+
+
+def prefetch_experiences(
+    replay_buffer: PackedReplayBuffer,
+    sampler: LengthBucketSampler,
+    device: torch.device,
+    copy_stream: torch.cuda.Stream,
+) -> Iterator[Experience]:
+    """Yield batches on device, copying the next batch on copy_stream meanwhile"""
+    compute_stream = torch.cuda.current_stream()
+    pending = None
+    for indices in sampler:
+        with torch.cuda.stream(copy_stream):
+            exp = replay_buffer.get_batch(indices).to(device)
+            copied = torch.cuda.Event()
+            copied.record()
+        if pending is not None:
+            yield _wait_for_copy(*pending, compute_stream)
+        pending = (exp, copied)
+    if pending is not None:
+        yield _wait_for_copy(*pending, compute_stream)
+
+
+def _wait_for_copy(
+    exp: Experience, copied: torch.cuda.Event, stream: torch.cuda.Stream
+) -> Experience:
+    stream.wait_event(copied)
+    for field in fields(exp):
+        v = getattr(exp, field.name)
+        if isinstance(v, torch.Tensor):
+            # allocated on the copy stream, keep it alive while used on stream
+            v.record_stream(stream)
+    return exp
+
+
+def copy_experience_to_host(
+    exp: Experience, copy_stream: torch.cuda.Stream
+) -> tuple[Experience, torch.cuda.Event]:
+    """Start a non-blocking copy of exp into pinned host memory on copy_stream"""
+    copy_stream.wait_stream(torch.cuda.current_stream())
+    members = {}
+    with torch.cuda.stream(copy_stream):
+        for field in fields(exp):
+            v = getattr(exp, field.name)
+            if isinstance(v, torch.Tensor):
+                # allocated on the compute stream, keep it alive until copied
+                v.record_stream(copy_stream)
+                host = torch.empty(v.shape, dtype=v.dtype, pin_memory=True)
+                v = host.copy_(v, non_blocking=True)
+            members[field.name] = v
+        copied = torch.cuda.Event()
+        copied.record()
+    return Experience(**members), copied
+
+
+def tokenize_prompts(
+    tokenizer: PreTrainedTokenizer, tasks: list[str]
+) -> list[torch.Tensor]:
+    chat_prompts = [
+        tokenizer.apply_chat_template(
+            [
+                {
+                    "role": "system",
+                    "content": system_prompt,
+                },
+                {
+                    "role": "user",
+                    "content": task,
+                },
+            ],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+        for task in tasks
+    ]
+    return [
+        torch.tensor(ids, dtype=torch.int32)
+        for ids in tokenizer(chat_prompts)["input_ids"]
+    ]
+
+
+def load_prompt_cache(
+    cache_path: Path,
+    file_name: str,
+    tokenizer: PreTrainedTokenizer,
+    predicate: Optional[Callable[[dict[str, np.ndarray]], np.ndarray]] = None,
+    max_rows: Optional[int] = None,
+) -> dict[str, Any]:
+    """Read and tokenize prompts on rank 0 only, all ranks memory-map the result"""
+    if dist.get_rank() == 0:
+        rows = read_prompts(file_name, predicate=predicate, max_rows=max_rows)
+        prompt_ids = tokenize_prompts(tokenizer, [x["question"] for x in rows])
+        seqlens = torch.tensor([ids.size(0) for ids in prompt_ids], dtype=torch.int32)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        torch.save(
+            {
+                "question": [x["question"] for x in rows],
+                "answer": [x["answer"] for x in rows],
+                "input_ids": torch.cat(prompt_ids),
+                "cu_seqlens": F.pad(seqlens.cumsum(dim=0, dtype=torch.int32), (1, 0)),
+            },
+            cache_path,
+        )
+    dist.barrier()
+    return torch.load(cache_path, mmap=True, weights_only=True)
 
 
 def read_jsonl(file_name: str | Path) -> Iterator:
@@ -184,16 +440,22 @@ def read_jsonl(file_name: str | Path) -> Iterator:
 
 def read_prompts(
     file_name: str,
-    predicate: Optional[Callable[[Any], bool]] = None,
+    predicate: Optional[Callable[[dict[str, np.ndarray]], np.ndarray]] = None,
     max_rows: Optional[int] = None,
 ) -> list:
-    rows = []
-    for x in read_jsonl(file_name):
-        if predicate is None or predicate(x):
-            rows.append(x)
-        if max_rows is not None and len(rows) >= max_rows:
-            break
-    return rows
+    """Read rows, filtered by a vectorized predicate over numpy columns"""
+    rows = list(read_jsonl(file_name))
+    if predicate is None:
+        return rows[:max_rows]
+
+    class Columns(dict):
+        # build a column array only when the predicate first asks for it
+        def __missing__(self, key: str) -> np.ndarray:
+            self[key] = np.array([x[key] for x in rows])
+            return self[key]
+
+    keep = np.flatnonzero(predicate(Columns()))
+    return [rows[i] for i in keep[:max_rows]]
 
 
 def setup_dist():
@@ -209,9 +471,12 @@ def load_model_fsdp(
     model_name_or_path: str,
     reduce_fp32: bool = False,
     reshard_after_forward: bool = True,
+    offload_params: bool = False,
+    checkpoint_every_n_layers: int = 0,
+    compile_layers: bool = False,
     trust_remote_code: bool = False,
 ) -> tuple[LlamaForCausalLM, PreTrainedTokenizer]:
-    """Load model and apply composable FSDP"""
+    """Load model and apply composable FSDP, optionally keeping sharded params on CPU"""
     tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
     tokenizer.pad_token = tokenizer.eos_token
 
@@ -227,18 +492,39 @@ def load_model_fsdp(
         param_dtype=torch.bfloat16,
         reduce_dtype=torch.float32 if reduce_fp32 else None,
     )
+    offload_policy = CPUOffloadPolicy() if offload_params else OffloadPolicy()
+
+    # Selective activation checkpointing, wrap every n-th layer before sharding so
+    # the remaining layers keep their activations and skip the recompute
+    if checkpoint_every_n_layers > 0:
+        for layer_id, transformer_block in enumerate(model.model.layers):
+            if layer_id % checkpoint_every_n_layers == 0:
+                model.model.layers[layer_id] = checkpoint_wrapper(
+                    transformer_block,
+                    checkpoint_impl=CheckpointImpl.NO_REENTRANT,
+                    preserve_rng_state=False,
+                )
+
+    # Compile each decoder block in place (after activation checkpointing, before
+    # sharding) so FSDP's hooks stay outside the compiled graphs and state dict
+    # keys are unchanged
+    if compile_layers:
+        for transformer_block in model.model.layers:
+            transformer_block.compile()
 
     # Apply FSDP to transformer layers
     for layer_id, transformer_block in enumerate(model.model.layers):
-        # Reshard all layers except the last one if enabled
-        should_reshard = (
-            reshard_after_forward and layer_id < len(model.model.layers) - 1
+        # Reshard all layers except the last one if enabled, offloaded models
+        # reshard every layer so no unsharded params stay resident
+        should_reshard = reshard_after_forward and (
+            offload_params or layer_id < len(model.model.layers) - 1
         )
 
         fully_shard(
             transformer_block,
             mp_policy=mp_policy,
             reshard_after_forward=should_reshard,
+            offload_policy=offload_policy,
         )
 
     # Apply FSDP to the whole model
@@ -246,8 +532,16 @@ def load_model_fsdp(
         model,
         mp_policy=mp_policy,
         reshard_after_forward=reshard_after_forward,
+        offload_policy=offload_policy,
     )
 
+    # Explicitly prefetch the neighbouring layer's all-gather so it overlaps
+    # with the current layer's compute in both forward and backward
+    layers = list(model.model.layers)
+    for prev_block, next_block in zip(layers[:-1], layers[1:]):
+        prev_block.set_modules_to_forward_prefetch([next_block])
+        next_block.set_modules_to_backward_prefetch([prev_block])
+
     return model, tokenizer
 
 
@@ -257,6 +551,7 @@ def main():
     model_name = "meta-llama/Llama-3.2-1B-Instruct"
     checkpoint_path = Path("./output")
     checkpoint_interval = 20
+    prompt_cache_path = Path("./output/prompts.pt")
     train_batch_size = 16
     lr = 5e-6
     kl_weight = 0.01
@@ -265,6 +560,14 @@ def main():
     # FSDP specific configs
     reduce_fp32 = False
     reshard_after_forward = False
+    offload_reference_model = True
+    checkpoint_every_n_layers = 2  # activation checkpointing, 0 disables it
+
+    # opt-in: load a full int8 copy of the frozen reference model on every rank
+    # instead of the offloaded bf16 shards. It stays resident on the GPU and
+    # LLM.int8() matmuls are slower than bf16, check rollout_kl and step time
+    # before enabling it
+    quantize_reference_model = False
 
     group_size = 12
     rollouts_per_step = 32
@@ -276,54 +579,101 @@ def main():
     top_p = 1.0
     temperature = 1.0
 
+    # torch.compile the decoder blocks of the policy and reference models
+    compile_model = True
+
+    # vLLM rollout engine, falls back to HF generate when disabled
+    use_vllm = True
+    vllm_gpu_memory_utilization = 0.3
+    vllm_tensor_parallel_size = 1
+
+    # Expandable segments reduce fragmentation when alternating between rollout
+    # and training allocations. vLLM's sleep mode uses its own memory pool,
+    # which is incompatible with expandable segments.
+    if not use_vllm:
+        os.environ.setdefault(
+            "PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512"
+        )
+
     # Initialize distributed setup
     setup_dist()
     init_rng(seed)
 
     # Load models with composable FSDP
-    reference_model, _ = load_model_fsdp(
-        model_name,
-        reduce_fp32=reduce_fp32,
-        reshard_after_forward=reshard_after_forward,
-    )
+    if quantize_reference_model:
+        reference_model, _ = load_model(
+            model_name, device_map={"": dist.get_rank()}, load_in_8bit=True
+        )
+    else:
+        # the reference model is only used for one forward per step, keep its
+        # sharded params on CPU and gather them layer by layer when needed
+        reference_model, _ = load_model_fsdp(
+            model_name,
+            reduce_fp32=reduce_fp32,
+            reshard_after_forward=True,
+            offload_params=offload_reference_model,
+            compile_layers=compile_model,
+        )
     model, tokenizer = load_model_fsdp(
         model_name,
         reduce_fp32=reduce_fp32,
         reshard_after_forward=reshard_after_forward,
+        checkpoint_every_n_layers=checkpoint_every_n_layers,
+        compile_layers=compile_model,
     )
 
-    optimizer = optim.Adam(model.parameters(), lr=lr)
+    llm = None
+    if use_vllm:
+        llm = load_vllm(
+            model_name,
+            max_length=max_length,
+            gpu_memory_utilization=vllm_gpu_memory_utilization,
+            tensor_parallel_size=vllm_tensor_parallel_size,
+            seed=seed,
+        )
+        llm.sleep(level=1)
+
+    # fused=True runs the whole update as a single kernel per parameter group
+    optimizer = optim.AdamW(
+        model.parameters(), lr=lr, betas=(0.9, 0.95), weight_decay=0.0, fused=True
+    )
 
     reference_model.eval()
     model.train()
 
-    # Enable gradient checkpointing
-    model.gradient_checkpointing_enable(
-        gradient_checkpointing_kwargs={"use_reentrant": False}
-    )
-
     pad_token_id = tokenizer.eos_token_id
 
-    prompts = read_prompts(
+    prompts = load_prompt_cache(
+        prompt_cache_path,
         "data/math_tasks.jsonl",
-        predicate=lambda x: len(x["question"]) < 128
-        and x["num_terms"] <= 3
-        and x["num_digits"] <= 3,
+        tokenizer,
+        predicate=lambda x: (np.char.str_len(x["question"]) < 128)
+        & (x["num_terms"] <= 3)
+        & (x["num_digits"] <= 3),
         max_rows=64 * 1024,
     )
+    prompt_cu_seqlens = prompts["cu_seqlens"].tolist()
 
     if dist.get_rank() == 0:
-        print(f"found {len(prompts)} matching prompts")
+        print(f"found {len(prompts['question'])} matching prompts")
 
     prompt_loader = DataLoader(
-        prompts,
+        range(len(prompts["question"])),
         batch_size=rollouts_per_step,
         shuffle=True,
         drop_last=True,
-        pin_memory=True,
     )
 
-    replay_buffer = ReplayBuffer()
+    replay_buffer = PackedReplayBuffer()
+    # side stream for experience copies between host and GPU, overlaps with
+    # the rollout forwards and with training
+    copy_stream = torch.cuda.Stream()
+    append_pool = ThreadPoolExecutor(max_workers=1)
+
+    def append_experience(exp: Experience, copied: torch.cuda.Event) -> None:
+        copied.synchronize()
+        replay_buffer.append(exp)
+
     objective = GRPOLoss(clip_eps=clip_eps, kl_weight=kl_weight)
 
     # Initialize wandb only on rank 0
@@ -334,52 +684,106 @@ def main():
             wandb.init(project=wandb_project)
 
     for k, prompt_batch in enumerate(prompt_loader):
-        rollout_returns = []
-
         replay_buffer.clear()
-
-        questions = prompt_batch["question"]
-        answers = prompt_batch["answer"]
+        append_futures = []
+        num_skipped_groups = 0
+        rollout_kl_sum = torch.zeros((), device="cuda")
+
+        indices = prompt_batch.tolist()
+        questions = [prompts["question"][i] for i in indices]
+        answers = [prompts["answer"][i] for i in indices]
+        prompt_ids = [
+            prompts["input_ids"][prompt_cu_seqlens[i] : prompt_cu_seqlens[i + 1]].long()
+            for i in indices
+        ]
+
+        if llm is not None:
+            llm.wake_up()
+            sync_vllm_weights(llm, model)
+            model.eval()
 
         with torch.no_grad():
-            for q, a in zip(questions, answers):
-                sequence_ids, returns, action_mask, completions = rollout(
+            if llm is not None:
+                all_sequence_ids, all_returns, all_action_mask = rollout_vllm(
+                    llm,
+                    tokenizer,
+                    prompt_ids,
+                    answers,
+                    num_rollouts=group_size,
+                    max_length=max_length,
+                    temperature=temperature,
+                    top_p=top_p,
+                )
+                # the sequences are plain tensors now, release the engine's
+                # weights and KV cache before the log-prob forwards
+                llm.sleep(level=1)
+            else:
+                all_sequence_ids, all_returns, all_action_mask = rollout(
                     model,
                     tokenizer,
-                    q,
-                    a,
+                    prompt_ids,
+                    answers,
                     num_rollouts=group_size,
                     max_length=max_length,
                     temperature=temperature,
                     top_p=top_p,
                 )
 
+            # identical rewards give all-zero advantages and no policy gradient.
+            # Every rank must run the same number of FSDP forwards, so group i
+            # is only skipped if it has identical rewards on all ranks.
+            skip_group = (
+                all_returns.view(-1, group_size).std(dim=1) < 1e-6
+            ).to(device="cuda", dtype=torch.int32)
+            dist.all_reduce(skip_group, op=dist.ReduceOp.MIN)
+            skip_group = skip_group.bool().tolist()
+
+            for i, (q, a) in enumerate(zip(questions, answers)):
+                group = slice(i * group_size, (i + 1) * group_size)
+                sequence_ids = all_sequence_ids[group]
+                action_mask = all_action_mask[group]
+                attention_mask = sequence_ids != pad_token_id
+
+                group_returns = all_returns[group]
+
                 if dist.get_rank() == 0:
                     print(
-                        f"rollout q='{q}', a='{a}', returns={returns.sum().item():.2f}, "
+                        f"rollout q='{q}', a='{a}', returns={group_returns.sum().item():.2f}, "
                         f"replay_buffer_size={len(replay_buffer)}, sequence_ids={sequence_ids.shape}"
                     )
 
-                rollout_returns.append(returns.cpu())
-
-                advantages = group_advantages(returns)
-                attention_mask = sequence_ids != pad_token_id
+                # skip the forwards and keep the group out of the buffer
+                if skip_group[i]:
+                    num_skipped_groups += 1
+                    continue
 
                 log_probs = sequences_log_probs(
                     model=model,
                     sequence_ids=sequence_ids,
                     attention_mask=attention_mask,
-                )
-                log_probs_ref = sequences_log_probs(
-                    model=reference_model,
-                    sequence_ids=sequence_ids,
-                    attention_mask=attention_mask,
-                )
-                kl = approx_kl_divergence(
-                    log_probs=log_probs,
-                    log_probs_ref=log_probs_ref,
                     action_mask=action_mask,
                 )
+                # the reference model is frozen, compute its log probs once per
+                # experience and skip it entirely when the KL term is disabled
+                log_probs_ref = None
+                kl = None
+                if kl_weight > 0:
+                    with torch.inference_mode():
+                        log_probs_ref = sequences_log_probs(
+                            model=reference_model,
+                            sequence_ids=sequence_ids,
+                            attention_mask=attention_mask,
+                            action_mask=action_mask,
+                        )
+                    kl = approx_kl_divergence(
+                        log_probs=log_probs,
+                        log_probs_ref=log_probs_ref,
+                        action_mask=action_mask,
+                    )
+                    rollout_kl_sum += masked_mean(kl, action_mask, dim=-1).sum()
+
+                returns = group_returns.to(sequence_ids.device)
+                advantages = group_advantages(returns)
 
                 experience = Experience(
                     sequences=sequence_ids,
@@ -391,31 +795,62 @@ def main():
                     action_mask=action_mask,
                     kl=kl,
                 )
-                replay_buffer.append(experience.to("cpu"))
+                # copy to host and pack in the background while the next
+                # group's forwards run, one worker keeps the buffer in order
+                append_futures.append(
+                    append_pool.submit(
+                        append_experience,
+                        *copy_experience_to_host(experience, copy_stream),
+                    )
+                )
 
-        if dist.get_rank() == 0:
-            episode_return_sum = torch.stack(rollout_returns).sum()
-            print(f"returns of step {k}: {episode_return_sum:.4f}")
-            wandb.log({"returns": episode_return_sum})
+            for future in append_futures:
+                future.result()
 
-        experience_sampler = DataLoader(
-            replay_buffer,
+        torch.cuda.synchronize()
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+
+        if dist.get_rank() == 0:
+            # returns are scored on the CPU, summing them needs no device sync
+            episode_return_sum = all_returns.sum().item()
+            # track the rollout KL to check the effect of the quantized reference
+            num_kept_groups = len(questions) - num_skipped_groups
+            rollout_kl = rollout_kl_sum.item() / max(num_kept_groups * group_size, 1)
+            skipped_fraction = num_skipped_groups / len(questions)
+            print(
+                f"returns of step {k}: {episode_return_sum:.4f}, kl={rollout_kl:.4f}, "
+                f"skipped_groups={skipped_fraction:.2f}"
+            )
+            wandb.log(
+                {
+                    "returns": episode_return_sum,
+                    "rollout_kl": rollout_kl,
+                    "skipped_groups": skipped_fraction,
+                }
+            )
+
+        experience_sampler = LengthBucketSampler(
+            replay_buffer.seqlens().tolist(),
             batch_size=train_batch_size,
-            shuffle=True,
             drop_last=True,
-            collate_fn=join_experience_batch,
         )
 
         for step_epoch in range(epochs_per_step):
             model.train()
 
-            for i, exp in enumerate(experience_sampler):
-                exp = exp.to(dist.get_rank())
+            experiences = prefetch_experiences(
+                replay_buffer, experience_sampler, dist.get_rank(), copy_stream
+            )
+            for i, exp in enumerate(experiences):
 
                 optimizer.zero_grad()
 
                 log_probs = sequences_log_probs(
-                    model, sequence_ids=exp.sequences, attention_mask=exp.attention_mask
+                    model,
+                    sequence_ids=exp.sequences,
+                    attention_mask=exp.attention_mask,
+                    action_mask=exp.action_mask,
                 )
 
                 loss, kl = objective.forward(log_probs=log_probs, experience=exp)
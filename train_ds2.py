@@ -4,7 +4,8 @@ import os
 from pathlib import Path
 import random
 import re
-from typing import Any, Iterator, Optional
+from typing import Iterator, Optional
+import numpy as np
 import wandb
 import torch
 import torch.optim as optim
@@ -13,7 +14,9 @@ from torch.nn.utils import clip_grad_norm_
 from torch.utils.data import DataLoader
 
 import os
-os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
+os.environ.setdefault(
+    "PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512"
+)
 
 from transformers import (
     AutoTokenizer,
@@ -23,7 +26,12 @@ from transformers import (
 )
 from ckpt_utils import save_checkpoint
 from loss import approx_kl_divergence, GRPOLoss
-from replay_buffer import ReplayBuffer, Experience, join_experience_batch
+from replay_buffer import (
+    ReplayBuffer,
+    Experience,
+    LengthBucketSampler,
+    join_experience_batch,
+)
 
 
 def load_model(
@@ -48,13 +56,15 @@ The assistant first thinks about the reasoning process in the mind and then prov
 <answer> answer here </answer>
 """
 
+answer_pattern = re.compile(r"<answer>(.*?)</answer>", flags=re.DOTALL)
+
 
 @torch.no_grad()
 def rollout(
     model: LlamaForCausalLM,
     tokenizer: PreTrainedTokenizer,
-    task: str,
-    oracle_answer: str,
+    tasks: list[str],
+    oracle_answers: list[str],
     num_rollouts: int,
     max_length: int = 512,
     temperature: float = 1.0,
@@ -63,37 +73,41 @@ def rollout(
 
     model.eval()
 
-    # 1. format prompt
-    chat_messages = [
-        {
-            "role": "system",
-            "content": system_prompt,
-        },
-        {
-            "role": "user",
-            "content": task,
-        },
+    # 1. format prompts
+    chat_prompts = [
+        tokenizer.apply_chat_template(
+            [
+                {
+                    "role": "system",
+                    "content": system_prompt,
+                },
+                {
+                    "role": "user",
+                    "content": task,
+                },
+            ],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+        for task in tasks
     ]
-    chat_prompt = tokenizer.apply_chat_template(
-        chat_messages, tokenize=False, add_generation_prompt=True
-    )
     model_inputs = tokenizer(
-        [chat_prompt],
+        chat_prompts,
         return_tensors="pt",
         padding=True,
         padding_side="left",
         return_attention_mask=True,
     ).to("cuda")  # Move inputs to GPU
 
-    # duplicate prompt num_rollouts times
-    model_inputs["attention_mask"] = model_inputs["attention_mask"].repeat(
-        num_rollouts, 1
+    # duplicate each prompt num_rollouts times, groups stay contiguous
+    model_inputs["attention_mask"] = model_inputs["attention_mask"].repeat_interleave(
+        num_rollouts, dim=0
     )
 
-    input_ids = model_inputs["input_ids"].repeat(num_rollouts, 1)
+    input_ids = model_inputs["input_ids"].repeat_interleave(num_rollouts, dim=0)
     model_inputs["input_ids"] = input_ids
 
-    # 2. sample completions
+    # 2. sample completions for all groups in a single generate call
     pad_token_id = tokenizer.eos_token_id
     generation_config = GenerationConfig(
         do_sample=True,
@@ -113,28 +127,27 @@ def rollout(
     action_mask = action_mask[:, 1:]
 
     # 3. determine rewards
-    returns = torch.zeros(num_rollouts, 1, dtype=torch.float)
+    returns = torch.zeros(len(completions), 1, dtype=torch.float)
     for i, completion in enumerate(completions):
+        oracle_answer = oracle_answers[i // num_rollouts]
         # search answer tag
-        answer_match = re.search(
-            r"<answer>(.*?)</answer>",
-            completion,
-            flags=re.DOTALL,
-        )
+        answer_match = answer_pattern.search(completion)
 
         answer = answer_match.group(1) if answer_match else None
         reward = 0
         if answer is not None:
-            if answer == oracle_answer:
+            # exact match iff the oracle is found and the lengths agree
+            if answer.find(oracle_answer) == -1:
+                reward = 0.01
+            elif len(answer) == len(oracle_answer):
                 reward = 1.0
-            elif oracle_answer in answer:
-                reward = 0.5
             else:
-                reward = 0.01
+                reward = 0.5
 
         returns[i] = reward
 
-    return sequence_ids, returns.to(sequence_ids.device), action_mask, completions
+    # returns stay on the CPU, logging and the skip check need no device sync
+    return sequence_ids, returns, action_mask, completions
 
 
 def init_rng(seed: int) -> torch.Generator:
@@ -146,19 +159,32 @@ def group_advantages(returns: torch.Tensor, eps: float = 1e-8) -> torch.Tensor:
     return (returns - returns.mean()) / (returns.std() + eps)
 
 
+@torch.compile(fullgraph=True, dynamic=True)
 def sequence_log_probs_from_logits(
     logits: torch.tensor, output_ids: torch.tensor
 ) -> torch.Tensor:
-    # log_prob = F.log_softmax(logits, dim=-1)
-    log_prob = F.log_softmax(logits.to(torch.float16), dim=-1)
-    return log_prob.gather(dim=-1, index=output_ids.unsqueeze(-1)).squeeze(-1)
+    # log p(target) = logit[target] - logsumexp(logits), the upcast happens
+    # inside the fused kernel so no fp32 [B, T, V] tensor is materialized
+    logits = logits.float()
+    lse = torch.logsumexp(logits, dim=-1)
+    target = logits.gather(dim=-1, index=output_ids.unsqueeze(-1)).squeeze(-1)
+    return target - lse
 
 
 def sequences_log_probs(
     model: LlamaForCausalLM,
     sequence_ids: torch.Tensor,
     attention_mask: torch.Tensor,
+    action_mask: Optional[torch.Tensor] = None,
 ) -> torch.Tensor:
+    seq_len = sequence_ids.size(1)
+
+    # only positions from the first action onward need to go through the LM head
+    start = 0
+    if action_mask is not None:
+        action_columns = action_mask.any(dim=0).nonzero()
+        start = action_columns[0].item() if len(action_columns) > 0 else seq_len - 1
+
     position_ids = attention_mask.long().cumsum(dim=-1) - 1
     position_ids.masked_fill_(mask=(attention_mask == 0), value=1)
     output = model(
@@ -166,13 +192,15 @@ def sequences_log_probs(
         attention_mask=attention_mask,
         position_ids=position_ids,
         use_cache=False,
+        logits_to_keep=seq_len - start,
     )
     logits = output["logits"]
     log_probs = sequence_log_probs_from_logits(
-        logits=logits[:, :-1].to(torch.float32),
-        output_ids=sequence_ids[:, 1:],
+        logits=logits[:, :-1],
+        output_ids=sequence_ids[:, start + 1 :],
     )
-    return log_probs
+    # prompt positions are masked out by action_mask, fill them with zeros
+    return F.pad(log_probs, (start, 0))
 
 
 def read_jsonl(file_name: str | Path) -> Iterator:
@@ -184,16 +212,22 @@ def read_jsonl(file_name: str | Path) -> Iterator:
 
 def read_prompts(
     file_name: str,
-    predicate: Optional[Callable[[Any], bool]] = None,
+    predicate: Optional[Callable[[dict[str, np.ndarray]], np.ndarray]] = None,
     max_rows: Optional[int] = None,
 ) -> list:
-    rows = []
-    for x in read_jsonl(file_name):
-        if predicate is None or predicate(x):
-            rows.append(x)
-        if max_rows is not None and len(rows) >= max_rows:
-            break
-    return rows
+    """Read rows, filtered by a vectorized predicate over numpy columns"""
+    rows = list(read_jsonl(file_name))
+    if predicate is None:
+        return rows[:max_rows]
+
+    class Columns(dict):
+        # build a column array only when the predicate first asks for it
+        def __missing__(self, key: str) -> np.ndarray:
+            self[key] = np.array([x[key] for x in rows])
+            return self[key]
+
+    keep = np.flatnonzero(predicate(Columns()))
+    return [rows[i] for i in keep[:max_rows]]
 
 
 def main():
@@ -227,7 +261,10 @@ def main():
     reference_model, tokenizer = load_model(model_name)
     model, _ = load_model(model_name)
 
-    optimizer = optim.Adam(model.parameters(), lr=lr)
+    # fused=True runs the whole update as a single kernel per parameter group
+    optimizer = optim.AdamW(
+        model.parameters(), lr=lr, betas=(0.9, 0.95), weight_decay=0.0, fused=True
+    )
 
     reference_model.eval()
     model.train()
@@ -241,9 +278,9 @@ def main():
 
     prompts = read_prompts(
         "data/math_tasks.jsonl",
-        predicate=lambda x: len(x["question"]) < 128
-        and x["num_terms"] <= 2
-        and x["num_digits"] <= 2,
+        predicate=lambda x: (np.char.str_len(x["question"]) < 128)
+        & (x["num_terms"] <= 2)
+        & (x["num_digits"] <= 2),
         max_rows=32 * 1024,
     )
 
@@ -267,33 +304,42 @@ def main():
         wandb.init(project=wandb_project)
 
     for k, prompt_batch in enumerate(prompt_loader):
-        rollout_returns = []
-
         replay_buffer.clear()
 
         questions = prompt_batch["question"]
         answers = prompt_batch["answer"]
 
         with torch.no_grad():
-            for q, a in zip(questions, answers):
-                sequence_ids, returns, action_mask, completions = rollout(
-                    model,
-                    tokenizer,
-                    q,
-                    a,
-                    num_rollouts=group_size,
-                    max_length=max_length,
-                    temperature=temperature,
-                    top_p=top_p,
-                )
+            all_sequence_ids, all_returns, all_action_mask, _ = rollout(
+                model,
+                tokenizer,
+                questions,
+                answers,
+                num_rollouts=group_size,
+                max_length=max_length,
+                temperature=temperature,
+                top_p=top_p,
+            )
+            num_skipped_groups = 0
+
+            for i, (q, a) in enumerate(zip(questions, answers)):
+                group = slice(i * group_size, (i + 1) * group_size)
+                sequence_ids = all_sequence_ids[group]
+                returns = all_returns[group]
+                action_mask = all_action_mask[group]
 
                 print(
                     f"rollout q='{q}', a='{a}', returns={returns.sum().item():.2f}, "
                     f"replay_buffer_size={len(replay_buffer)}, sequence_ids={sequence_ids.shape}"
                 )
 
-                rollout_returns.append(returns.cpu())
+                # identical rewards give all-zero advantages and no policy
+                # gradient, skip the forwards and keep them out of the buffer
+                if returns.std() < 1e-6:
+                    num_skipped_groups += 1
+                    continue
 
+                returns = returns.to(sequence_ids.device)
                 advantages = group_advantages(returns)
                 attention_mask = sequence_ids != pad_token_id
 
@@ -301,17 +347,25 @@ def main():
                     model=model,
                     sequence_ids=sequence_ids,
                     attention_mask=attention_mask,
-                )
-                log_probs_ref = sequences_log_probs(
-                    model=reference_model,
-                    sequence_ids=sequence_ids,
-                    attention_mask=attention_mask,
-                )
-                kl = approx_kl_divergence(
-                    log_probs=log_probs,
-                    log_probs_ref=log_probs_ref,
                     action_mask=action_mask,
                 )
+                # the reference model is frozen, skip it entirely when the KL
+                # term is disabled
+                log_probs_ref = None
+                kl = None
+                if kl_weight > 0:
+                    with torch.inference_mode():
+                        log_probs_ref = sequences_log_probs(
+                            model=reference_model,
+                            sequence_ids=sequence_ids,
+                            attention_mask=attention_mask,
+                            action_mask=action_mask,
+                        )
+                    kl = approx_kl_divergence(
+                        log_probs=log_probs,
+                        log_probs_ref=log_probs_ref,
+                        action_mask=action_mask,
+                    )
 
                 experience = Experience(
                     sequences=sequence_ids,
@@ -325,15 +379,26 @@ def main():
                 )
                 replay_buffer.append(experience.to("cpu"))
 
-        episode_return_sum = torch.stack(rollout_returns).sum()
-        print(f"returns of step {k}: {episode_return_sum:.4f}")
-        wandb.log({"returns": episode_return_sum})
+        # release generation buffers before the training phase
+        torch.cuda.synchronize()
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+
+        episode_return_sum = all_returns.sum().item()
+        skipped_fraction = num_skipped_groups / len(questions)
+        print(
+            f"returns of step {k}: {episode_return_sum:.4f}, "
+            f"skipped_groups={skipped_fraction:.2f}"
+        )
+        wandb.log({"returns": episode_return_sum, "skipped_groups": skipped_fraction})
 
         experience_sampler = DataLoader(
             replay_buffer,
-            batch_size=train_batch_size,
-            shuffle=True,
-            drop_last=True,
+            batch_sampler=LengthBucketSampler(
+                [item.sequences.size(0) for item in replay_buffer.items],
+                batch_size=train_batch_size,
+                drop_last=True,
+            ),
             collate_fn=join_experience_batch,
         )
 
@@ -346,7 +411,10 @@ def main():
                 optimizer.zero_grad()
 
                 log_probs = sequences_log_probs(
-                    model, sequence_ids=exp.sequences, attention_mask=exp.attention_mask
+                    model,
+                    sequence_ids=exp.sequences,
+                    attention_mask=exp.attention_mask,
+                    action_mask=exp.action_mask,
                 )
 
                 loss, kl = objective.forward(log_probs=log_probs, experience=exp)